@@ -161,6 +161,13 @@ class IAFormer(nn.Module):
 
         return loss
 
+    def to_inference(self, dtype=torch.bfloat16):
+        # Reduced-precision attention stacks for evaluation only
+        self.eval()
+        self.Att = Att.to_inference(self.Att, dtype)
+        self.AP.AP_att = Att.to_inference(self.AP.AP_att, dtype)
+        return self
+
 
     def get_dct_matrix(self, N):
         # Computes the discrete cosine transform (DCT) matrix and its inverse (IDCT)
@@ -1,3 +1,5 @@
+import functools
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,19 +9,129 @@ Attention Block was redesigned with reference to
 https://github.com/hyunwoongko/transformer.git
 """
 
+def split_heads(x, num_heads, chunks=1):
+    """(B, T, chunks * D) -> chunks views of (B, H, T, D // H)."""
+    batch_size, seq_len, dim = x.size()
+    x = x.view(batch_size, seq_len, chunks, num_heads, dim // (chunks * num_heads)).permute(2, 0, 3, 1, 4)
+    return x[0] if chunks == 1 else x.unbind(0)
+
+
+def merge_heads(x):
+    """(B, H, T, head_dim) -> contiguous (B, T, H * head_dim)."""
+    batch_size, num_heads, seq_len, head_dim = x.size()
+    return x.transpose(1, 2).contiguous().view(batch_size, seq_len, num_heads * head_dim)
+
+
+@functools.lru_cache(maxsize=16)
+def window_index(seq_len, window_sizes, device, causal=False):
+    """Clamped (T, W_max) window gather index and (levels, T, W_max) mask of the positions not attended."""
+    with torch.inference_mode(False):
+        max_pad = (max(window_sizes) - 1) // 2
+        offset = torch.arange(-max_pad, 1 if causal else max_pad + 1, device=device)
+        idx = torch.arange(seq_len, device=device)[:, None] + offset[None, :]
+        outside = torch.stack([
+            (idx < 0) | (idx >= seq_len) | (offset.abs() > (window_size - 1) // 2)
+            for window_size in window_sizes
+        ])
+        return idx.clamp(0, seq_len - 1), outside
+
+
+def additive_mask(mask, dtype):
+    """Keep-mask (mask == 0 is not attended) -> additive {0, finfo(dtype).min} bias of the same shape."""
+    return torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill(mask == 0, torch.finfo(dtype).min)
+
+
+@functools.lru_cache(maxsize=16)
+def causal_bias(seq_len, src_len, dtype, device):
+    """Additive (T, S) bias, finfo(dtype).min above the diagonal."""
+    with torch.inference_mode(False):
+        return torch.full((seq_len, src_len), torch.finfo(dtype).min, dtype=dtype, device=device).triu(1)
+
+
+def scaled_dot_product_attention(q, k, v, mask=None, dropout_p=0.0, scale=None, is_causal=False):
+    """softmax(q k^T * scale) v over (B, H, T, head_dim), mask is a keep-mask broadcastable to (B, H, T, S)."""
+    # The only place keep-masks become additive biases
+    attn_bias = None if mask is None else additive_mask(mask, q.dtype)
+
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias, dropout_p=dropout_p, is_causal=is_causal)
+
+    if scale is None:
+        scale = q.size(-1) ** -0.5
+    if is_causal:
+        causal = causal_bias(q.size(-2), k.size(-2), q.dtype, q.device)
+        attn_bias = causal if attn_bias is None else torch.minimum(attn_bias, causal)
+    batch_size, num_heads, seq_len, head_dim = q.size()
+    q = q.reshape(batch_size * num_heads, seq_len, head_dim)
+    k = k.reshape(batch_size * num_heads, -1, head_dim)
+    v = v.reshape(batch_size * num_heads, -1, head_dim)
+
+    if attn_bias is None:
+        scores = torch.bmm(q, k.transpose(1, 2))
+        scores.mul_(scale)
+    else:
+        # Scale, bias add and matmul in a single cuBLAS call, per-batch / per-head biases flattened to (B * H, T, S)
+        if attn_bias.dim() > 2 and attn_bias.shape[:-2].numel() == 1:
+            attn_bias = attn_bias.view(attn_bias.shape[-2:])
+        if attn_bias.dim() > 2:
+            attn_bias = attn_bias.expand(batch_size, num_heads, seq_len, k.size(1)).reshape(batch_size * num_heads, seq_len, -1)
+        scores = torch.baddbmm(attn_bias, q, k.transpose(1, 2), alpha=scale)
+    weights = F.softmax(scores, dim=-1)
+    weights = F.dropout(weights, dropout_p)
+    return torch.bmm(weights, v).view(batch_size, num_heads, seq_len, head_dim)
+
+
+@functools.lru_cache(maxsize=None)
+def compiled(fn):
+    """torch.compile'd fn, built on first use."""
+    return torch.compile(fn)
+
+
+def feed_forward(x, norm, linear1, linear2, p, training):
+    """Pre-norm residual FFN branch x + dropout(linear2(gelu(linear1(norm(x)))))."""
+    return x + F.dropout(linear2(F.gelu(linear1(norm(x)))), p, training)
+
+
+def fused_feed_forward(x, norm_weight, norm_bias, eps, w1, b1, w2, b2, p, training):
+    """feed_forward on the LayerNorm / linear tensors, for compiled()."""
+    x_norm = F.layer_norm(x, x.shape[-1:], norm_weight, norm_bias, eps)
+    return x + F.dropout(F.linear(F.gelu(F.linear(x_norm, w1, b1)), w2, b2), p, training)
+
+
+def banded_attention(query, key, value, idx, outside, scale):
+    """(B, H, T, head_dim) queries over the key/value windows idx, one softmax per level mask, (L, B, H, T, head_dim)."""
+    # Temporal windows over the projections, (B, H, T, W_max, head_dim)
+    key = key[:, :, idx]
+    value = value[:, :, idx]
+
+    # Attention scores of the widest window, restricted per level, (L, B, H, T, W_max)
+    scores = torch.einsum('bhtd,bhtwd->bhtw', query, key)
+    scores.mul_(scale)
+    scores = scores.unsqueeze(0).masked_fill(outside[:, None, None], float('-inf'))
+
+    weights = F.softmax(scores, dim=-1)
+    return torch.einsum('lbhtw,bhtwd->lbhtd', weights, value)
+
+
+# Widest window sent through compiled(banded_attention) when use_compile is set
+SMALL_WINDOW = 8
+
+
 class HierarchicalTemporalAttention(nn.Module):
-    def __init__(self, hidden_dim, num_heads, dropout, window_sizes=[3, 5, 7], num_levels=3):
+    def __init__(self, hidden_dim, num_heads, dropout, window_sizes=[3, 5, 7], num_levels=3, causal=False,
+                 use_compile=False):
         super().__init__()
         self.hidden_dim = hidden_dim
         self.num_heads = num_heads
         self.window_sizes = window_sizes  # Different window sizes for each level
         self.num_levels = num_levels
+        self.causal = causal  # Attend to past tokens only
+        if use_compile and not hasattr(torch, 'compile'):
+            raise RuntimeError('use_compile needs torch.compile (torch >= 2.0)')
+        self.use_compile = use_compile  # torch.compile the small-window attention
 
-        # Local Temporal Attention modules for each level
-        self.local_attentions = nn.ModuleList([
-            MultiHeadAttention(num_heads, hidden_dim) 
-            for _ in range(num_levels)
-        ])
+        # Local Temporal Attention, shared by all levels (only the window size differs)
+        self.local_attention = MultiHeadAttention(num_heads, hidden_dim)
         
         # Global Temporal Attention
         self.global_attention = MultiHeadAttention(num_heads, hidden_dim)
@@ -28,52 +140,65 @@ class HierarchicalTemporalAttention(nn.Module):
         self.linear_out = nn.Linear(hidden_dim * (num_levels + 1), hidden_dim)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, bias=None, mask=None):
-        B, T, D = x.size()
-        local_features = []
-
-        # Move input to GPU if available
-        device = x.device
+        # Fusion input reused across inference calls, see fusion_buffer
+        self._cat_buf = None
 
-        # Process each hierarchical level
-        for level in range(self.num_levels):
-            window_size = self.window_sizes[level]
-            pad_size = (window_size - 1) // 2
-            
-            # Pad sequence temporally
-            padded_x = F.pad(x, (0, 0, pad_size, pad_size), 'constant', 0)
-            
-            # Extract local windows using unfold (parallelized)
-            unfolded_x = padded_x.unfold(1, window_size, 1)  # (B, T, D, window_size)
-            unfolded_x = unfolded_x.permute(0, 1, 3, 2)  # (B, T, window_size, D)
-            unfolded_x = unfolded_x.contiguous().view(B * T, window_size, D)  # (B * T, window_size, D)
-            
-            # Process windows through attention (parallelized)
-            level_out = self.local_attentions[level](unfolded_x, unfolded_x, unfolded_x)
-            level_out = level_out.view(B, T, window_size, D)  # (B, T, window_size, D)
-            level_out = torch.mean(level_out, dim=2)  # Average over window_size to get (B, T, D)
-            local_features.append(level_out)
+    def forward(self, x, bias=None, mask=None):
+        # All hierarchical levels in one batched call
+        local_out = self.window_attention(x)  # (num_levels, B, T, D)
 
         # Global attention
-        global_out = self.global_attention(x, x, x)  # (B, T, D)
-        local_features.append(global_out)
+        global_out = self.global_attention(x, x, x, is_causal=self.causal)  # (B, T, D)
 
-        # Concatenate and fuse features
-        combined = torch.cat(local_features, dim=-1)  # (B, T, D * (num_levels + 1))
+        # Write all levels into the fusion input at once and fuse features
+        combined = self.fusion_buffer(global_out)  # (B, T, D * (num_levels + 1))
+        stacked = combined.view(*global_out.shape[:-1], self.num_levels + 1, self.hidden_dim)  # (B, T, num_levels + 1, D)
+        stacked[..., :self.num_levels, :].copy_(local_out.permute(1, 2, 0, 3))
+        stacked[..., self.num_levels, :].copy_(global_out)
         out = self.linear_out(combined)
         out = self.dropout(out)
         
         return out, None
-    
+
+    def fusion_buffer(self, like):
+        """(B, T, D * (num_levels + 1)) input of linear_out, cached while autograd is off."""
+        shape = like.shape[:-1] + (self.hidden_dim * (self.num_levels + 1),)
+        if torch.is_grad_enabled():
+            return like.new_empty(shape)
+
+        buf = self._cat_buf
+        if buf is None or buf.shape != shape or buf.dtype != like.dtype or buf.device != like.device:
+            with torch.inference_mode(False):
+                buf = self._cat_buf = like.new_empty(shape)
+        return buf
+
+    def window_attention(self, x):
+        """Attention of every token over its window at each level, (num_levels, B, T, D)."""
+        T = x.size(1)
+        attention = self.local_attention
+        idx, outside = window_index(T, tuple(self.window_sizes[:self.num_levels]), x.device, self.causal)
+
+        # Linear projections, (B, H, T, head_dim)
+        query, key, value = attention.project(x, x, x)
+
+        # Attention of every level over its window, (L, B, H, T, head_dim)
+        small = self.use_compile and idx.size(1) <= SMALL_WINDOW
+        banded = compiled(banded_attention) if small else banded_attention
+        attended = banded(query, key, value, idx, outside, attention.scale)
+
+        # Merge heads and project all levels at once, (L, B, T, D)
+        attended = attended.transpose(2, 3).flatten(3)
+        return attention.output_linear(attended)
+
 class SelfAttention(nn.Module):
     def __init__(self, hidden_dim, num_heads, dropout):
         super().__init__()
         self.hidden_dim = hidden_dim
         self.num_heads = num_heads
         self.head_dim = hidden_dim // num_heads
-        self.linear_q = nn.Linear(hidden_dim, hidden_dim)
-        self.linear_k = nn.Linear(hidden_dim, hidden_dim)
-        self.linear_v = nn.Linear(hidden_dim, hidden_dim)
+        self.scale = self.head_dim ** -0.5
+        # Fused Q/K/V projection, one GEMM over x
+        self.linear_qkv = nn.Linear(hidden_dim, 3 * hidden_dim)
 
         # Dropout layer
         self.dropout = nn.Dropout(dropout)
@@ -83,63 +208,62 @@ class SelfAttention(nn.Module):
 
     def forward(self, x, bias=None, mask=None):
         batch_size, seq_len, hidden_dim  = x.size()  # b, s, h
-        k = self.linear_k(x)  # (batch_size, seq_len, hidden_dim)
+        # Split Q/K/V and the vector dimension of each head, (batch_size, num_heads, seq_len, head_dim)
         if bias is not None:
-            q = self.linear_q(x) + self.linear_q(bias)
+            # linear_q(x) + linear_q(bias) == W_q (x + bias) + 2 * b_q, a single GEMM for q
+            w_q, w_kv = self.linear_qkv.weight.split([hidden_dim, 2 * hidden_dim])
+            b_q, b_kv = self.linear_qkv.bias.split([hidden_dim, 2 * hidden_dim])
+            q = split_heads(F.linear(x + bias, w_q, 2 * b_q), self.num_heads)
+            k, v = split_heads(F.linear(x, w_kv, b_kv), self.num_heads, chunks=2)
         else:
-            q = self.linear_q(x)  # (batch_size, seq_len, hidden_dim)
-        v = self.linear_v(x)  # (batch_size, seq_len, hidden_dim)
-
-        # Split the vector dimension of each head
-        k = k.view(batch_size, self.num_heads, seq_len, self.head_dim)
-        q = q.view(batch_size, self.num_heads, seq_len, self.head_dim)
-        v = v.view(batch_size, self.num_heads, seq_len, self.head_dim)
-
-        # Calculating attention score
-        scores = torch.matmul(q, k.transpose(-2, -1)) / torch.sqrt(torch.tensor(self.head_dim).float())
-        if mask is not None:
-            scores = scores.masked_fill(mask == 0, -1e9)
-        attn_weights = F.softmax(scores, dim=-1)
-        attn_weights = self.dropout(attn_weights)
+            q, k, v = split_heads(self.linear_qkv(x), self.num_heads, chunks=3)
 
-        # Attention weight
-        attn_output = torch.matmul(attn_weights, v)
-        attn_output = attn_output.view(batch_size, seq_len, self.hidden_dim)
+        # Attention, the weights are not materialized
+        attn_output = scaled_dot_product_attention(q, k, v, mask, self.dropout.p if self.training else 0.0, self.scale)
+        attn_output = merge_heads(attn_output)  # (batch_size, seq_len, hidden_dim)
 
         # Output linear transformation layer
         attn_output = self.linear_out(attn_output)
         attn_output = self.dropout(attn_output)
 
-        return attn_output, attn_weights
+        return attn_output, None
 
 
 class TransformerEncoder(nn.Module):
-    def __init__(self, hidden_dim, num_layers, num_heads, dropout, window_sizes=[3,5,7]):
+    def __init__(self, hidden_dim, num_layers, num_heads, dropout, window_sizes=[3,5,7], use_compile=False):
         super().__init__()
+        if use_compile and not hasattr(torch, 'compile'):
+            raise RuntimeError('use_compile needs torch.compile (torch >= 2.0)')
+        self.use_compile = use_compile  # torch.compile the FFN and small-window attention
         self.layers = nn.ModuleList([
             nn.ModuleDict({
                 'temporal_attention': HierarchicalTemporalAttention(
-                    hidden_dim, num_heads, dropout, window_sizes),
+                    hidden_dim, num_heads, dropout, window_sizes, use_compile=use_compile),
                 'linear1': nn.Linear(hidden_dim, 4 * hidden_dim),
                 'linear2': nn.Linear(4 * hidden_dim, hidden_dim),
                 'norm1': nn.LayerNorm(hidden_dim),
                 'norm2': nn.LayerNorm(hidden_dim)
             }) for _ in range(num_layers)
         ])
+        # Final norm of the pre-norm residual stream
+        self.norm = nn.LayerNorm(hidden_dim)
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, x, bias=None, mask=None):
         for layer in self.layers:
-            # Temporal attention
-            attn_out, _ = layer['temporal_attention'](x, bias, mask)
-
-            x = layer['norm1'](x + self.dropout(attn_out))
-            
-            # FFN
-            ffn_out = layer['linear2'](F.gelu(layer['linear1'](x)))
-            x = layer['norm2'](x + self.dropout(ffn_out))
+            # Temporal attention (pre-norm)
+            attn_out, _ = layer['temporal_attention'](layer['norm1'](x), bias, mask)
+            x = x + self.dropout(attn_out)
+
+            # FFN (pre-norm)
+            if self.use_compile:
+                norm, linear1, linear2 = layer['norm2'], layer['linear1'], layer['linear2']
+                x = compiled(fused_feed_forward)(x, norm.weight, norm.bias, norm.eps, linear1.weight, linear1.bias,
+                                                 linear2.weight, linear2.bias, self.dropout.p, self.training)
+            else:
+                x = feed_forward(x, layer['norm2'], layer['linear1'], layer['linear2'], self.dropout.p, self.training)
             
-        return x, None
+        return self.norm(x), None
 
 class MultiHeadAttention(nn.Module):
     def __init__(self, num_heads, d_model):
@@ -147,48 +271,46 @@ class MultiHeadAttention(nn.Module):
 
         self.num_heads = num_heads
         self.d_model = d_model
-        self.query_linear = nn.Linear(d_model, d_model)
-        # print(d_model, self.query_linear.weight.shape)
-        self.key_linear = nn.Linear(d_model, d_model)
-        self.value_linear = nn.Linear(d_model, d_model)
+        self.head_dim = d_model // num_heads
+        self.scale = self.head_dim ** -0.5
+        # Fused Q/K/V projection
+        self.in_proj = nn.Linear(d_model, 3 * d_model)
 
         self.output_linear = nn.Linear(d_model, d_model)
 
-    def forward(self, query, key, value, mask=None):
-        batch_size = query.size(0)
-
-        # Linear projections
-        query = self.query_linear(query)
-        key = self.key_linear(key)
-        value = self.value_linear(value)
-
-        # Reshape to split heads
-        query = query.view(batch_size * self.num_heads, -1, self.d_model // self.num_heads)
-        key = key.view(batch_size * self.num_heads, -1, self.d_model // self.num_heads)
-        value = value.view(batch_size * self.num_heads, -1, self.d_model // self.num_heads)
-
-        # Calculate attention scores
-        scores = torch.bmm(query, key.transpose(1, 2))
-        scores = scores / (self.d_model // self.num_heads) ** 0.5
-
-        # Apply mask
-        if mask is not None:
-            scores = scores.masked_fill(mask == 0, -1e9)
-
-        # Softmax to get attention weights
-        weights = nn.functional.softmax(scores, dim=-1)
+    def forward(self, query, key, value, mask=None, is_causal=False):
+        # Linear projections, split into heads (B, H, T, head_dim)
+        query, key, value = self.project(query, key, value)
 
-        # Apply attention weights to values
-        attended = torch.bmm(weights, value)
+        # Attention over all positions
+        attended = scaled_dot_product_attention(query, key, value, mask, scale=self.scale, is_causal=is_causal)
 
         # Reshape back to original shape
-        attended = attended.view(batch_size, -1, self.d_model)
+        attended = merge_heads(attended)
 
         # Linear projection to get final output
         output = self.output_linear(attended)
 
         return output
 
+    def project(self, query, key, value):
+        """Q/K/V projections split into heads, (B, H, T, head_dim) each."""
+        if query is key and key is value:
+            return split_heads(self.in_proj(query), self.num_heads, chunks=3)
+
+        w_q, w_kv = self.in_proj.weight.split([self.d_model, 2 * self.d_model])
+        b_q, b_kv = self.in_proj.bias.split([self.d_model, 2 * self.d_model])
+        query = split_heads(F.linear(query, w_q, b_q), self.num_heads)
+
+        # Cross-attention on a single memory, K/V in one GEMM
+        if key is value:
+            key, value = split_heads(F.linear(key, w_kv, b_kv), self.num_heads, chunks=2)
+            return query, key, value
+
+        w_k, w_v = w_kv.chunk(2)
+        b_k, b_v = b_kv.chunk(2)
+        return query, split_heads(F.linear(key, w_k, b_k), self.num_heads), split_heads(F.linear(value, w_v, b_v), self.num_heads)
+
 class TransformerDecoderLayer(nn.Module):
     def __init__(self, num_heads, d_model, d_ff, dropout):
         super().__init__()
@@ -218,7 +340,8 @@ class TransformerDecoderLayer(nn.Module):
 
         # Attention on Encoder Outputs
         tgt3 = self.enc_attention_norm(tgt2 + self.dropout(self.enc_attention(tgt2, memory, memory, memory_mask)))
-        if memo2 is not None:
+        # memo2 aliases memory without a second memory, a second pass would only differ by its dropout sample
+        if memo2 is not None and memo2 is not memory:
             tgt3_5 = self.enc_attention_norm(tgt2 + self.dropout(self.enc_attention(tgt2, memo2, memo2, memory_mask)))
             tgt3 = (tgt3 + tgt3_5)/2
 
@@ -245,17 +368,18 @@ class TransformerDecoder(nn.Module):
         # self.output_linear = nn.Linear(d_model, vocab_size)
 
     def forward(self, tgt, memory, memo2=None, embedding=None,tgt_mask=None, memory_mask=None):
+        # memory and memo2 do not change across layers, normalize them once
+        norm_memo1 = self.norm_att(memory)
+        if memo2 is not None:
+            norm_memo2 = self.norm_att(memo2)
+        else:
+            norm_memo2 = norm_memo1
 
         for i in range(self.num_layers):
             if embedding is not None:
                 norm_tgt = self.norm_att(tgt + embedding)
             else:
                 norm_tgt = self.norm_att(tgt)
-            norm_memo1 = self.norm_att(memory)
-            if memo2 is not None:
-                norm_memo2 = self.norm_att(memo2)
-            else:
-                norm_memo2 = norm_memo1
 
             tgt = self.layers[i](norm_tgt, norm_memo1, norm_memo2, tgt_mask=tgt_mask, memory_mask=memory_mask)
 
@@ -263,3 +387,35 @@ class TransformerDecoder(nn.Module):
         return output
 
 
+class AutocastInference(nn.Module):
+    """Runs the wrapped module under CUDA autocast to dtype."""
+    def __init__(self, module, dtype=torch.bfloat16):
+        super().__init__()
+        self.module = module
+        self.dtype = dtype
+
+    def forward(self, *args, **kwargs):
+        with torch.autocast(device_type='cuda', dtype=self.dtype):
+            return self.module(*args, **kwargs)
+
+
+def to_inference(module, dtype=torch.bfloat16):
+    """Eval-mode attention stack: dtype autocast on CUDA, int8 dynamic linears on CPU (dtype unused)."""
+    module.eval()
+
+    if isinstance(module, AutocastInference):
+        return module
+
+    if next(module.parameters()).is_cuda:
+        return AutocastInference(module, dtype)
+
+    # Fused Q/K/V projections keep float weights, forward slices them
+    fused = {name + '.in_proj' for name, m in module.named_modules() if isinstance(m, MultiHeadAttention)}
+    fused |= {name + '.linear_qkv' for name, m in module.named_modules() if isinstance(m, SelfAttention)}
+    linears = {name for name, m in module.named_modules() if isinstance(m, nn.Linear) and name not in fused}
+
+    # The compiled FFN reads float weights, quantized linears go through feed_forward
+    for m in module.modules():
+        if isinstance(m, TransformerEncoder):
+            m.use_compile = False
+    return torch.ao.quantization.quantize_dynamic(module, linears, dtype=torch.qint8)